@@ -1,16 +1,38 @@
+from __future__ import annotations
+
 import streamlit as st
 import streamlit.components.v1 as components
-import google.generativeai as genai
+import ahocorasick
 import os
 from dotenv import load_dotenv
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
 import json
-import html
+import re
+import threading
+from collections import Counter
+from collections.abc import Iterator
+from pathlib import Path
+from typing import TYPE_CHECKING
 
-# .envファイルを読み込み
-load_dotenv()
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
 st.set_page_config(page_title="金融商品説明事項チェックシステム", layout="wide")
 
+
+@st.cache_resource(show_spinner=False)
+def load_env() -> bool:
+    """.envファイルを読み込み（再実行のたびではなく、プロセス内で1度だけ）"""
+    return load_dotenv()
+
+
+load_env()
+
 st.title("金融商品説明事項チェックシステム")
 
 # セッション状態の初期化
@@ -18,10 +40,18 @@ if "source_text" not in st.session_state:
     st.session_state.source_text = ""
 if "compliance_results" not in st.session_state:
     st.session_state.compliance_results = []
+if "last_analyzed_hash" not in st.session_state:
+    st.session_state.last_analyzed_hash = ""
 
 # 表示高さを固定値に設定
 DISPLAY_HEIGHT = 650
 
+# インタラクティブ表示用のカスタムコンポーネント
+# 静的なHTML/CSS/JSはファイルとして配信され、再実行時はデータのみ送られる
+compliance_viewer = components.declare_component(
+    "compliance_viewer", path=str(Path(__file__).with_name("compliance_viewer"))
+)
+
 # API Key設定
 # Streamlit Cloudではst.secretsを使用
 gemini_api_key = None
@@ -36,55 +66,68 @@ if not gemini_api_key:
     st.stop()
 
 
-def check_compliance(text: str) -> list:
-    """説明事項チェックを実行"""
-    try:
-        genai.configure(api_key=gemini_api_key)
-        # NOTE: 将来的に gemini-2.5-pro に変更予定
-        model = genai.GenerativeModel("gemini-2.5-pro")
-
-        prompt = f"""
-金融商品の説明文書から以下の20項目についてチェックを行ってください。
-
-【チェック項目】
-1. 商品名称・種類の明確な説明
-2. 元本欠損（元本割れ）のおそれがある旨の説明
-3. 価格変動リスクの説明
-4. 金利変動リスクの説明
-5. 為替変動リスクの説明（該当商品の場合）
-6. 最大損失額・想定損失額の説明
-7. 購入時手数料の説明
-8. 運用管理費用（信託報酬）の説明
-9. 換金時手数料・制約の説明
-10. 投資経験の確認
-11. 投資目的の確認
-12. リスク許容度の確認
-13. 顧客属性に適した商品であることの確認
-14. 商品内容の理解確認
-15. リスクの理解確認
-16. 手数料の理解確認
-17. 契約締結前交付書面の交付
-18. 投資対象・運用方針の説明
-19. 換金可能時期・制限の説明
-20. 最終的な購入意思の確認
-
-【テキスト】
-{text}
+# チェック項目（項目番号, 項目名）
+CHECK_ITEMS = [
+    (1, "商品名称・種類の明確な説明"),
+    (2, "元本欠損（元本割れ）のおそれがある旨の説明"),
+    (3, "価格変動リスクの説明"),
+    (4, "金利変動リスクの説明"),
+    (5, "為替変動リスクの説明（該当商品の場合）"),
+    (6, "最大損失額・想定損失額の説明"),
+    (7, "購入時手数料の説明"),
+    (8, "運用管理費用（信託報酬）の説明"),
+    (9, "換金時手数料・制約の説明"),
+    (10, "投資経験の確認"),
+    (11, "投資目的の確認"),
+    (12, "リスク許容度の確認"),
+    (13, "顧客属性に適した商品であることの確認"),
+    (14, "商品内容の理解確認"),
+    (15, "リスクの理解確認"),
+    (16, "手数料の理解確認"),
+    (17, "契約締結前交付書面の交付"),
+    (18, "投資対象・運用方針の説明"),
+    (19, "換金可能時期・制限の説明"),
+    (20, "最終的な購入意思の確認"),
+]
+
+# スニペット照合用の正規表現
+SENTENCE_SPLIT_RE = re.compile(r"[。．！？\n]|\.\.\.")  # 句読点、改行、省略記号
+SPEAKER_ONLY_RE = re.compile(r"^(顧客|店員)[：:]?$")
+SPEAKER_LABEL_RE = re.compile(r"^(顧客|店員)[：:]\s*")
+LEADING_SYMBOLS_RE = re.compile(r"^[\s.\-…]+")
+TRAILING_PUNCT_RE = re.compile(r"[。．！？]+$")
+WHITESPACE_RE = re.compile(r"\s+")
+NON_WHITESPACE_RE = re.compile(r"\S+")
+ASTRAL_CHAR_RE = re.compile("[\U00010000-\U0010ffff]")
+
+# Geminiへの同時リクエスト数の上限（RPM制限を考慮）
+MAX_CONCURRENT_REQUESTS = 8
+
+# 判定結果1件分のJSONスキーマ（Geminiのresponse_schemaに渡す）
+# 項目番号・項目名はリクエスト側で付与するため出力させない
+COMPLIANCE_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["○", "△", "×"]},
+        "confidence": {"type": "integer"},
+        "snippet": {"type": "string"},
+        "reason": {"type": "string"},
+    },
+    "required": ["status", "confidence", "snippet", "reason"],
+}
+
+
+# 全リクエストで共通の指示（出力形式・判定基準）
+# モデル生成時にシステム指示として1度だけ設定し、リクエストごとには送らない
+SYSTEM_INSTRUCTION = """
+金融商品の説明文書から、指定されたチェック項目についてチェックを行ってください。
 
 【出力形式】
-以下のJSON形式で出力してください：
-{{
-    "compliance_results": [
-        {{
-            "item_no": 項目番号,
-            "item_name": "項目名",
-            "status": "○" または "△" または "×",
-            "confidence": 信頼度（0-100の整数）,
-            "snippet": "該当箇所の文章（改行は...で置換して1行で出力）",
-            "reason": "判定理由の簡潔な説明"
-        }}
-    ]
-}}
+以下を出力してください：
+- status: "○" または "△" または "×"
+- confidence: 信頼度（0-100の整数）
+- snippet: 該当箇所の文章（改行は...で置換して1行で出力）
+- reason: 判定理由の簡潔な説明
 
 判定基準：
 - ○：ヒアリングできた（質問せずとも相手が話してくれた、または、正しく質問して相手が明確に回答した）
@@ -93,376 +136,310 @@ def check_compliance(text: str) -> list:
   信頼度：10-90（説明の質に応じて。良い説明なら90に近く、不十分なら10に近く）
 - ×：話として出てこなかった、または、的外れな回答をした
   信頼度：100
+"""
+
+
+@st.cache_resource
+def get_model(api_key: str) -> genai.GenerativeModel:
+    """Geminiモデルを生成（プロセス内で1度だけ生成し、再実行間で再利用）"""
+    # 分析を実行するまでgRPC等の重い依存を読み込まないよう、ここでimportする
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    # NOTE: 将来的に gemini-2.5-pro に変更予定
+    return genai.GenerativeModel(
+        "gemini-2.5-pro",
+        system_instruction=SYSTEM_INSTRUCTION,
+        # JSONモードで出力させるため、コードフェンスの除去は不要
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": COMPLIANCE_RESULT_SCHEMA,
+        },
+    )
+
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """非同期API呼び出し用のイベントループを生成（バックグラウンドスレッドで常駐）
+
+    Geminiの非同期クライアントは最初に使われたイベントループに紐づくため、
+    asyncio.runで毎回ループを作り直さず、同じループを使い続ける。
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def get_request_semaphore() -> asyncio.Semaphore:
+    """Geminiへの同時リクエスト数を制限するセマフォを生成（全セッションで共有）
+
+    RPM制限はAPI Key単位のため、分析ごとではなくプロセス全体で上限を守る。
+    使用するのは get_event_loop のループ上のみ。
+    """
+    return asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+
+class PartialCheckError(Exception):
+    """一部の項目が判定エラーになったことを表す例外（判定できた結果も保持）
+
+    例外として送出することで、部分的な失敗結果がキャッシュされないようにする。
+    """
+
+    def __init__(self, results: list, errors: list):
+        super().__init__(f"{len(errors)}項目の判定に失敗しました: {errors[0]}")
+        self.results = results
+        self.errors = errors
+
+
+async def _check_one(
+    item_no: int,
+    item_name: str,
+    text: str,
+    model: genai.GenerativeModel,
+    semaphore: asyncio.Semaphore,
+) -> dict:
+    """1項目分の説明事項チェックを実行"""
+    # 全項目で共通のテキストを先頭に置き、項目ごとに異なる部分は末尾にまとめる
+    prompt = f"""
+【テキスト】
+{text}
 
-JSONのみを出力し、他の説明は不要です。
+【チェック項目】
+{item_no}. {item_name}
 """
 
-        response = model.generate_content(prompt)
+    async with semaphore:
+        response = await model.generate_content_async(prompt)
+    return {"item_no": item_no, "item_name": item_name, **json.loads(response.text)}
+
+
+def render_summary(results: list) -> None:
+    """結果サマリーを表示（3列レイアウト）"""
+    # 結果をカウント（1回の走査で全ステータスを集計）
+    counts = Counter(r["status"] for r in results)
+    if counts["エラー"]:
+        st.caption(
+            f"⚠️ 判定エラー {counts['エラー']}件（適合・不適合の集計には含めていません）"
+        )
+
+    col_ok, col_partial, col_ng = st.columns(3)
+    with col_ok:
+        st.metric(
+            "✅ 適合",
+            f"{counts['○']}件",
+            f"{counts['○'] / len(results) * 100:.1f}%",
+        )
+    with col_partial:
+        st.metric(
+            "⚠️ 部分適合",
+            f"{counts['△']}件",
+            f"{counts['△'] / len(results) * 100:.1f}%",
+        )
+    with col_ng:
+        st.metric(
+            "❌ 不適合",
+            f"{counts['×']}件",
+            f"{counts['×'] / len(results) * 100:.1f}%",
+        )
+
+
+def iter_check_results(
+    text: str,
+) -> Iterator[tuple[tuple[int, str], dict | BaseException]]:
+    """全項目のチェックを並列に実行し、完了した順に結果を返す
 
-        # JSONパース
-        try:
-            json_text = response.text.strip()
-            if json_text.startswith("```json"):
-                json_text = json_text[7:]
-            if json_text.endswith("```"):
-                json_text = json_text[:-3]
+    各要素は ((項目番号, 項目名), 判定結果dict または 発生した例外)。
+    途中で打ち切られた場合（再実行などでスクリプトが停止した場合）は、
+    未完了のリクエストをキャンセルしてクォータを消費し続けないようにする。
+    """
+    model = get_model(gemini_api_key)
+    loop = get_event_loop()
+    semaphore = get_request_semaphore()
+    futures = {
+        asyncio.run_coroutine_threadsafe(
+            _check_one(item_no, item_name, text, model, semaphore), loop
+        ): (item_no, item_name)
+        for item_no, item_name in CHECK_ITEMS
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.exception() or future.result()
+    finally:
+        # ループ側のタスクもキャンセルされる（完了済みのものには影響しない）
+        # 実行中のタスクより先にセマフォ待ちのタスク（後に投入したもの）を止め、
+        # 空いた枠で新たなリクエストが始まらないようにする
+        for future in reversed(list(futures)):
+            future.cancel()
 
-            result = json.loads(json_text.strip())
-            return result.get("compliance_results", [])
-        except (json.JSONDecodeError, KeyError):
-            return []
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def check_compliance(text: str) -> list:
+    """説明事項チェックを実行（同一テキストの結果はキャッシュから返す）
+
+    API Keyは引数に含めず、キャッシュキーをテキスト内容のみにする。
+    完了した項目から順にサマリーを更新表示する。
+    1項目でも失敗した場合は例外を送出し、失敗結果がキャッシュされないようにする。
+    """
+    progress = st.empty()
+    results = []
+    errors = []
+    # 停止時にジェネレータを確実に閉じ、未完了のリクエストをキャンセルする
+    with contextlib.closing(iter_check_results(text)) as outcomes:
+        for (item_no, item_name), outcome in outcomes:
+            # 個別に失敗した項目は×（不適合）と区別し、判定エラーとして扱う
+            if isinstance(outcome, BaseException):
+                errors.append(outcome)
+                outcome = {
+                    "item_no": item_no,
+                    "item_name": item_name,
+                    "status": "エラー",
+                    "confidence": 0,
+                    "snippet": "",
+                    "reason": f"判定エラー: {outcome}",
+                }
+            results.append(outcome)
+
+            with progress.container():
+                st.caption(f"分析中... {len(results)}/{len(CHECK_ITEMS)}項目完了")
+                render_summary(results)
+    progress.empty()
+
+    if len(errors) == len(CHECK_ITEMS):
+        raise errors[0]
+    results.sort(key=lambda r: r["item_no"])
+    if errors:
+        raise PartialCheckError(results, errors)
+    return results
+
+
+def run_compliance_check(text: str) -> list:
+    """説明事項チェックを実行し、失敗時はエラーを表示して空リストを返す
+
+    一部の項目のみ失敗した場合は、判定エラーの項目を含む結果を返す（キャッシュはしない）。
+    """
+    try:
+        return check_compliance(text)
+    except PartialCheckError as e:
+        return e.results
+    except json.JSONDecodeError:
+        return []
     except Exception as e:
         st.error(f"エラー: {e}")
         return []
 
 
-def create_interactive_display(text: str, results: list, height: int = 650) -> str:
-    """インタラクティブな表示を生成（st.rerun不要）"""
-    escaped_text = html.escape(text)
-    results_json = json.dumps(results, ensure_ascii=False)
-
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <style>
-            body {{
-                font-family: sans-serif;
-                margin: 0;
-                padding: 0;
-                background-color: #f5f5f5;
-            }}
-            .main-container {{
-                max-width: 100%;
-                margin: 0 auto;
-            }}
-            
-            /* 上段のスタイル */
-            .top-section {{
-                display: flex;
-                gap: 20px;
-                margin-bottom: 20px;
-            }}
-            
-            /* 下段のスタイル */
-            .bottom-section {{
-                display: flex;
-                gap: 20px;
-            }}
-            
-            .left-panel {{
-                flex: 1.2;
-            }}
-            
-            .right-panel {{
-                flex: 1;
-            }}
-            
-            .section-box {{
-                background: white;
-                border-radius: 8px;
-                padding: 20px;
-                box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-            }}
-            
-            #text-container {{
-                height: {height}px;
-                overflow-y: auto;
-                padding: 20px;
-                border: 1px solid #ddd;
-                border-radius: 5px;
-                line-height: 1.6;
-                font-size: 14px;
-                background: white;
-            }}
-            
-            .results-container {{
-                height: {height}px;
-                overflow-y: auto;
-                padding: 10px;
-            }}
-            
-            .result-card {{
-                padding: 12px;
-                border-radius: 8px;
-                margin-bottom: 8px;
-                border-left: 4px solid;
-                position: relative;
-            }}
-            
-            .result-card.ok {{
-                background-color: #d4edda;
-                border-left-color: #155724;
-            }}
-            
-            .result-card.partial {{
-                background-color: #fff3cd;
-                border-left-color: #856404;
-            }}
-            
-            .result-card.ng {{
-                background-color: #f8d7da;
-                border-left-color: #721c24;
-            }}
-            
-            .result-header {{
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                margin-bottom: 5px;
-            }}
-            
-            .result-title {{
-                margin: 0;
-                font-size: 14px;
-                flex: 1;
-            }}
-            
-            .confidence-badge {{
-                padding: 2px 6px;
-                border-radius: 8px;
-                font-size: 10px;
-                color: white;
-            }}
-            
-            .result-content {{
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-            }}
-            
-            .result-reason {{
-                margin: 0;
-                color: #666;
-                font-size: 12px;
-                flex: 1;
-            }}
-            
-            .highlight-button {{
-                padding: 2px 8px;
-                height: 25px;
-                font-size: 11px;
-                background-color: #f0f2f6;
-                border: 1px solid #d1d5db;
-                border-radius: 4px;
-                cursor: pointer;
-                transition: background-color 0.2s;
-            }}
-            
-            .highlight-button:hover {{
-                background-color: #e5e7eb;
-            }}
-            
-            .highlight {{
-                background-color: #ffeb3b;
-                padding: 2px 4px;
-                font-weight: bold;
-                border-radius: 3px;
-            }}
-            
-            h3 {{
-                margin-top: 0;
-                font-size: 16px;
-                color: #1f2937;
-            }}
-            
-            .info-text {{
-                color: #6b7280;
-                font-size: 14px;
-                margin: 10px 0;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="main-container">
-            <div class="bottom-section">
-                <div class="left-panel">
-                    <div class="section-box">
-                        <h3>📄 全文表示</h3>
-                        <div id="text-container">{escaped_text.replace(chr(10), "<br>")}</div>
-                        <div class="info-text">文字数: {len(text)}文字</div>
-                    </div>
-                </div>
-                <div class="right-panel">
-                    <div class="section-box">
-                        <h3>🔍 詳細チェック結果</h3>
-                        <div class="results-container" id="results-container"></div>
-                    </div>
-                </div>
-            </div>
-        </div>
-        
-        <script>
-            const results = {results_json};
-            let currentHighlight = null;
-            let lastScrollPosition = 0;
-            
-            const textContainer = document.getElementById('text-container');
-            const resultsContainer = document.getElementById('results-container');
-            
-            // スクロール位置を記憶
-            textContainer.addEventListener('scroll', function() {{
-                lastScrollPosition = textContainer.scrollTop;
-            }});
-            
-            // 文ごとの区切り関数
-            function splitIntoSentences(text) {{
-                // 句読点、改行、省略記号で区切り、空文字を除去
-                return text.split(/[。．！？\\n]|\\.\\.\\./g).filter(s => s.trim().length > 0);
-            }}
-            
-            // テキスト正規化関数（空白・改行を統一）
-            function normalizeText(text) {{
-                return text.replace(/\\s+/g, ' ').trim();
-            }}
-            
-            // 改善されたハイライト関数
-            function highlightSnippet(snippet) {{
-                if (!snippet) return;
-                
-                // 現在のスクロール位置を保存
-                const currentScroll = textContainer.scrollTop;
-                
-                // 同じハイライトをクリックした場合はクリア
-                if (currentHighlight === snippet) {{
-                    currentHighlight = null;
-                    restoreText();
-                    textContainer.scrollTop = currentScroll;
-                    return;
-                }}
-                
-                // テキストを元に戻してから新しいハイライトを適用
-                restoreText();
-                
-                // 文ごとに分割してハイライト処理
-                const sentences = splitIntoSentences(snippet);
-                const textContent = textContainer.innerHTML;
-                let highlightedText = textContent;
-                let foundMatch = false;
-                
-                // 各文について一致を試行
-                sentences.forEach((sentence, index) => {{
-                    const trimmedSentence = sentence.trim();
-                    // 短すぎる文や話者ラベルのみの文はスキップ
-                    if (trimmedSentence.length < 3 || /^(顧客|店員)[：:]?$/.test(trimmedSentence)) return;
-                    
-                    // スピーカーラベルと記号を除去して検索用文章を作成
-                    const cleanedSentence = trimmedSentence
-                        .replace(/^(顧客|店員)[：:]\\s*/, '')    // 話者ラベルを除去
-                        .replace(/^[\\s\\.\\-…]+/, '')         // 先頭記号を除去
-                        .replace(/[。．！？]+$/, '')          // 末尾句読点を除去
-                        .trim();
-                    const searchSentence = cleanedSentence || trimmedSentence;
-                    
-                    // 正規化してマッチング
-                    const normalizedSentence = normalizeText(searchSentence);
-                    const escapedSentence = normalizedSentence.replace(/[.*+?^${{}}()|[\\]\\\\]/g, '\\\\$&');
-                    
-                    // 複数のマッチングパターンを試行
-                    const patterns = [
-                        // 完全一致
-                        new RegExp(escapedSentence, 'gi'),
-                        // 前後の空白を考慮
-                        new RegExp(`\\\\s*${{escapedSentence}}\\\\s*`, 'gi'),
-                        // HTMLタグ間の改行を考慮
-                        new RegExp(escapedSentence.replace(/\\s+/g, '[\\\\s<br>]*'), 'gi')
-                    ];
-                    
-                    for (let pattern of patterns) {{
-                        if (pattern.test(highlightedText)) {{
-                            const highlightId = index === 0 ? 'highlight-target' : `highlight-${{index}}`;
-                            highlightedText = highlightedText.replace(pattern, (match) => {{
-                                foundMatch = true;
-                                return `<span class="highlight" id="${{highlightId}}">${{match}}</span>`;
-                            }});
-                            break;
-                        }}
-                    }}
-                }});
-                
-                // ハイライトが適用された場合のみテキストを更新
-                if (foundMatch) {{
-                    textContainer.innerHTML = highlightedText;
-                    
-                    // 最初のハイライト要素へスクロール
-                    setTimeout(() => {{
-                        const highlightElement = document.getElementById('highlight-target');
-                        if (highlightElement) {{
-                            const elementTop = highlightElement.offsetTop;
-                            const containerHeight = textContainer.clientHeight;
-                            const targetScrollTop = elementTop - (containerHeight / 2) + (highlightElement.clientHeight / 2);
-                            
-                            textContainer.scrollTo({{
-                                top: Math.max(0, targetScrollTop),
-                                behavior: 'smooth'
-                            }});
-                        }}
-                    }}, 50);
-                    
-                    currentHighlight = snippet;
-                }} else {{
-                    // マッチしない場合は従来の方法を試行
-                    const escapedSnippet = snippet.replace(/[.*+?^${{}}()|[\\]\\\\]/g, '\\\\$&');
-                    const fallbackPattern = new RegExp(escapedSnippet.replace(/\\s+/g, '[\\\\s<br>]*'), 'gi');
-                    if (fallbackPattern.test(textContent)) {{
-                        highlightedText = textContent.replace(fallbackPattern, 
-                            `<span class="highlight" id="highlight-target">${{snippet}}</span>`);
-                        textContainer.innerHTML = highlightedText;
-                        currentHighlight = snippet;
-                    }}
-                }}
-            }}
-            
-            // テキストを元に戻す
-            function restoreText() {{
-                textContainer.innerHTML = `{escaped_text.replace(chr(10), "<br>")}`;
-            }}
-            
-            // 結果カードを作成
-            function createResultCards() {{
-                results.forEach((result, index) => {{
-                    const statusClass = result.status === '○' ? 'ok' : 
-                                      result.status === '△' ? 'partial' : 'ng';
-                    const statusIcon = result.status === '○' ? '✅' : 
-                                     result.status === '△' ? '⚠️' : '❌';
-                    const statusColor = result.status === '○' ? '#155724' : 
-                                      result.status === '△' ? '#856404' : '#721c24';
-                    
-                    const card = document.createElement('div');
-                    card.className = `result-card ${{statusClass}}`;
-                    
-                    card.innerHTML = `
-                        <div class="result-header">
-                            <h6 class="result-title" style="color: ${{statusColor}}">
-                                ${{statusIcon}} ${{result.item_no}}. ${{result.item_name}}
-                            </h6>
-                            <span class="confidence-badge" style="background-color: ${{statusColor}}">
-                                信頼度: ${{result.confidence}}%
-                            </span>
-                        </div>
-                        <div class="result-content">
-                            <p class="result-reason">${{result.reason}}</p>
-                            ${{result.snippet ? 
-                                `<button class="highlight-button" onclick="highlightSnippet('${{result.snippet.replace(/'/g, "\\\\'")}}')">
-                                    📍 該当箇所
-                                </button>` : ''
-                            }}
-                        </div>
-                    `;
-                    
-                    resultsContainer.appendChild(card);
-                }});
-            }}
-            
-            // 初期化
-            createResultCards();
-        </script>
-    </body>
-    </html>
+def _snippet_sentences(snippet: str) -> list:
+    """スニペットを検索用の文に分割（話者ラベル・記号・空白を除去）"""
+    sentences = []
+    for sentence in SENTENCE_SPLIT_RE.split(snippet):
+        sentence = sentence.strip()
+        # 短すぎる文や話者ラベルのみの文はスキップ
+        if len(sentence) < 3 or SPEAKER_ONLY_RE.match(sentence):
+            continue
+        cleaned = SPEAKER_LABEL_RE.sub("", sentence)
+        cleaned = LEADING_SYMBOLS_RE.sub("", cleaned)
+        cleaned = TRAILING_PUNCT_RE.sub("", cleaned).strip()
+        sentences.append(WHITESPACE_RE.sub("", cleaned or sentence))
+    return sentences
+
+
+def _fold_case(text: str) -> str:
+    """大文字・小文字を区別しない照合用に変換（文字数が変わる文字はそのまま残す）"""
+    folded = text.casefold()
+    # 全文字が1文字に変換される場合は文字位置がそのまま対応する
+    if len(folded) == len(text):
+        return folded
+    return "".join(c if len(c.casefold()) != 1 else c.casefold() for c in text)
+
+
+def _merge_ranges(ranges: list) -> list:
+    """重なり合う範囲を結合し、開始位置順に並べる"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def find_snippet_ranges(text: str, results: list) -> list:
+    """各結果のスニペットが全文中に現れる範囲 [start, end) の一覧を返す
+
+    全結果の検索語を1つのAho-Corasickオートマトンにまとめ、全文を1回だけ走査する。
+    空白・改行を除いた文字列同士で大文字・小文字を区別せずに照合し、
+    位置はブラウザ側の文字位置（UTF-16単位）に変換して返す。
     """
+    # 検索語 → [(結果の番号, スニペット全体での検索か)]
+    # スニペット全体での検索は、文ごとの検索で一致しなかった場合のみ使う
+    owners = {}
+    for index, result in enumerate(results):
+        snippet = result.get("snippet") or ""
+        for sentence in _snippet_sentences(snippet):
+            owners.setdefault(_fold_case(sentence), []).append((index, False))
+        fallback = _fold_case(WHITESPACE_RE.sub("", snippet))
+        owners.setdefault(fallback, []).append((index, True))
+    owners.pop("", None)
+
+    sentence_matches = [[] for _ in results]
+    fallback_matches = [[] for _ in results]
+    if not owners:
+        return sentence_matches
+
+    automaton = ahocorasick.Automaton()
+    for needle, needle_owners in owners.items():
+        automaton.add_word(needle, (len(needle), needle_owners))
+    automaton.make_automaton()
+
+    # 空白を除いた全文と、非空白の連続区間ごとの「除去後の開始位置」の対応表
+    runs = list(NON_WHITESPACE_RE.finditer(text))
+    normalized_text = _fold_case("".join(run.group() for run in runs))
+    run_starts = list(
+        itertools.accumulate((run.end() - run.start() for run in runs), initial=0)
+    )
+    # サロゲートペアになる文字の位置（JSでは2文字として数えられる）
+    astral_positions = [m.start() for m in ASTRAL_CHAR_RE.finditer(text)]
+
+    def to_text_index(normalized_index: int) -> int:
+        k = bisect.bisect_right(run_starts, normalized_index) - 1
+        return runs[k].start() + normalized_index - run_starts[k]
+
+    def to_js_offset(index: int) -> int:
+        return index + bisect.bisect_left(astral_positions, index)
+
+    for last, (length, needle_owners) in automaton.iter(normalized_text):
+        match = [
+            to_js_offset(to_text_index(last - length + 1)),
+            to_js_offset(to_text_index(last) + 1),
+        ]
+        for index, is_fallback in needle_owners:
+            (fallback_matches if is_fallback else sentence_matches)[index].append(match)
+
+    # マッチしない場合はスニペット全体での一致を使う
+    return [
+        _merge_ranges(sentences or fallback)
+        for sentences, fallback in zip(sentence_matches, fallback_matches)
+    ]
 
-    return html_content
+
+# 共有インスタンスでアップロード内容が残り続けないよう、件数と保持時間を制限する
+@st.cache_data(ttl=3600, max_entries=50, show_spinner=False)
+def load_text_file(file_bytes: bytes) -> str:
+    """アップロードされたテキストファイルをデコード"""
+    return file_bytes.decode("utf-8")
+
+
+@st.cache_data(ttl=3600, max_entries=50, show_spinner=False)
+def add_highlight_ranges(text: str, results: list) -> list:
+    """各結果にハイライト範囲（_ranges）を付与
+
+    ウィジェット操作による再実行では同じ内容で呼ばれるため、結果をキャッシュする。
+    """
+    return [
+        {**result, "_ranges": ranges}
+        for result, ranges in zip(results, find_snippet_ranges(text, results))
+    ]
 
 
 # ===== 上段: アップロード（左）+ サマリー（右） =====
@@ -481,9 +458,8 @@ with top_col1:
     )
 
     if uploaded_file is not None:
-        # ファイル内容を読み込み
-        file_content = str(uploaded_file.read(), "utf-8")
-        st.session_state.source_text = file_content
+        # ファイル内容を読み込み（同じ内容のファイルはデコード結果を再利用）
+        st.session_state.source_text = load_text_file(uploaded_file.getvalue())
         st.success(f"✅ ファイル「{uploaded_file.name}」を読み込みました")
 
     # 直接入力セクション（折りたたみ）
@@ -505,56 +481,60 @@ with top_col2:
 
     if st.session_state.source_text:
         # 分析実行ボタン
-        if st.button("🔍 分析実行", type="primary", use_container_width=True):
+        run_col, rerun_col = st.columns([2, 1])
+        with run_col:
+            run_clicked = st.button(
+                "🔍 分析実行", type="primary", use_container_width=True
+            )
+        with rerun_col:
+            rerun_clicked = st.button(
+                "🔄 強制再実行",
+                use_container_width=True,
+                help="キャッシュを使わずにAI分析をやり直します",
+            )
+
+        if rerun_clicked:
+            check_compliance.clear()
+
+        if run_clicked or rerun_clicked:
+            # 前回エラーなく分析したテキストと同じ場合は分析を省略（強制再実行時を除く）
+            text_hash = hashlib.blake2b(
+                st.session_state.source_text.encode(), digest_size=16
+            ).hexdigest()
+            already_analyzed = (
+                st.session_state.last_analyzed_hash == text_hash
+                and st.session_state.compliance_results
+            )
+
+        if run_clicked and already_analyzed:
+            st.info("前回と同じテキストのため、前回の分析結果を表示しています")
+        elif run_clicked or rerun_clicked:
             with st.spinner("AI分析中..."):
-                results = check_compliance(st.session_state.source_text)
+                results = run_compliance_check(st.session_state.source_text)
                 if results:
                     st.session_state.compliance_results = results
-                    # 結果サマリー
-                    ok_count = len([r for r in results if r["status"] == "○"])
-                    partial_count = len([r for r in results if r["status"] == "△"])
-                    ng_count = len([r for r in results if r["status"] == "×"])
-                    st.success(
-                        f"✅ チェック完了: ○{ok_count}件 △{partial_count}件 ×{ng_count}件"
+                    # 判定エラーの項目がある場合は再試行できるよう記録しない
+                    has_errors = any(r["status"] == "エラー" for r in results)
+                    st.session_state.last_analyzed_hash = (
+                        None if has_errors else text_hash
                     )
+                    # 結果サマリー（判定エラーは不適合と分けて表示）
+                    counts = Counter(r["status"] for r in results)
+                    summary = f"○{counts['○']}件 △{counts['△']}件 ×{counts['×']}件"
+                    if counts["エラー"]:
+                        st.warning(
+                            f"⚠️ {counts['エラー']}項目はAPIエラーのため判定できませんでした"
+                            f"（{summary}）。「分析実行」で再試行できます"
+                        )
+                    else:
+                        st.success(f"✅ チェック完了: {summary}")
                 else:
                     st.warning("分析結果を取得できませんでした")
 
         # サマリー表示
         if st.session_state.compliance_results:
             st.markdown("**📊 結果サマリー**")
-
-            # 結果をカウント
-            ok_items = [
-                r for r in st.session_state.compliance_results if r["status"] == "○"
-            ]
-            partial_items = [
-                r for r in st.session_state.compliance_results if r["status"] == "△"
-            ]
-            ng_items = [
-                r for r in st.session_state.compliance_results if r["status"] == "×"
-            ]
-
-            # サマリー表示（3列レイアウト）
-            col_ok, col_partial, col_ng = st.columns(3)
-            with col_ok:
-                st.metric(
-                    "✅ 適合",
-                    f"{len(ok_items)}件",
-                    f"{len(ok_items) / len(st.session_state.compliance_results) * 100:.1f}%",
-                )
-            with col_partial:
-                st.metric(
-                    "⚠️ 部分適合",
-                    f"{len(partial_items)}件",
-                    f"{len(partial_items) / len(st.session_state.compliance_results) * 100:.1f}%",
-                )
-            with col_ng:
-                st.metric(
-                    "❌ 不適合",
-                    f"{len(ng_items)}件",
-                    f"{len(ng_items) / len(st.session_state.compliance_results) * 100:.1f}%",
-                )
+            render_summary(st.session_state.compliance_results)
     else:
         st.info("ファイルをアップロードして開始してください")
 
@@ -565,13 +545,15 @@ st.markdown("---")
 st.subheader("📋 詳細表示")
 
 if st.session_state.source_text and st.session_state.compliance_results:
-    # インタラクティブな表示を生成
-    html_content = create_interactive_display(
-        st.session_state.source_text,
-        st.session_state.compliance_results,
-        DISPLAY_HEIGHT,
+    # インタラクティブな表示（ハイライト範囲はサーバー側で計算して渡す）
+    compliance_viewer(
+        text=st.session_state.source_text,
+        results=add_highlight_ranges(
+            st.session_state.source_text, st.session_state.compliance_results
+        ),
+        height=DISPLAY_HEIGHT,
+        key="compliance_viewer",
     )
-    components.html(html_content, height=DISPLAY_HEIGHT + 100)
 elif st.session_state.source_text:
     # 結果がない場合はテキストのみ表示
     col1, col2 = st.columns([1.2, 1])